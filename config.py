@@ -14,6 +14,59 @@ custom_sort_3_elems
   So sort on second and third elements 
   which are the station id and cast number
 
+Standard pressure levels (optional)
+  STANDARD_LEVEL_METHOD is None to skip, 'bin' to average good
+  values in bins centered on each level or 'interpolate' to
+  linearly interpolate good values onto each level.
+  Levels are STANDARD_LEVELS if given, otherwise every
+  STANDARD_LEVEL_INTERVAL dbar from the surface.
+  If STANDARD_LEVEL_ONLY is True, the raw N_level file isn't saved.
+
+Projection (optional)
+  PARAMETERS is a list of parameter names to keep, e.g.
+  ['CTDPRS', 'CTDTMP', 'CTDSAL']. Their flags are kept too.
+  An empty list keeps all parameters.
+  PRESSURE_RANGE is (min, max) dbar of rows to keep or None
+  to keep all rows.
+
+STREAMING
+  If True, read and write one cast at a time straight into the
+  NetCDF file so memory doesn't grow with the number of casts.
+  DERIVE_TEOS10, standard levels, WRITE_MASKED_PARAMETERS,
+  FLAG_STORAGE other than 'variables', the ragged NETCDF_LAYOUT and
+  SAVE_MAT need all casts at once and raise an error if set.
+
+DERIVE_TEOS10
+  If True, compute absolute salinity, conservative temperature,
+  potential temperature and sigma0 with the gsw package from
+  good CTDPRS, CTDTMP and CTDSAL values.
+
+NETCDF_LAYOUT
+  'padded' saves parameters as (N_profile, N_level) arrays.
+  'ragged' saves the levels of all profiles one after the other
+  along N_obs with ROW_SIZE giving the levels in each profile.
+  Streaming conversion only supports 'padded'.
+
+SAVE_MAT
+  If True, also save all variables, units and global attributes
+  to a mat file in MAT_DIR. Not supported with STREAMING.
+
+EXCHANGE_WORKERS
+  Number of processes used to write exchange files from a NetCDF
+  file with write_exchange.py. None uses the number of CPUs.
+
+ACCEPTED_FLAGS
+  WOCE flags of values to use when making derived products
+  and masked parameters
+
+QC flags
+  If WRITE_MASKED_PARAMETERS is True, a <name>_MASKED variable is
+  saved for each parameter with values not having an accepted
+  flag set to NaN.
+  FLAG_STORAGE is 'variables' to save each flag as its own variable,
+  'matrix' to save all flags in one QC_FLAGS variable or 'packed'
+  to save two flags per byte in one QC_FLAGS_PACKED variable.
+
 """
 
 from pathlib import Path
@@ -27,6 +80,30 @@ class Config:
   OUTPUT_DIR = DATA_DIR.joinpath('output/')
   NETCDF_DIR = OUTPUT_DIR.joinpath('netcdf/')
   MAT_DIR = OUTPUT_DIR.joinpath('mat/')
+  EXCHANGE_DIR = OUTPUT_DIR.joinpath('exchange/')
 
 
   SORT_ROUTINE = 'custom_sort_3_elems'
+
+  PARAMETERS = []
+  PRESSURE_RANGE = None
+
+  STREAMING = False
+
+  DERIVE_TEOS10 = False
+
+  NETCDF_LAYOUT = 'padded'
+
+  SAVE_MAT = False
+
+  EXCHANGE_WORKERS = None
+
+  ACCEPTED_FLAGS = [2]
+
+  WRITE_MASKED_PARAMETERS = False
+  FLAG_STORAGE = 'variables'
+
+  STANDARD_LEVEL_METHOD = None
+  STANDARD_LEVEL_INTERVAL = 2
+  STANDARD_LEVELS = []
+  STANDARD_LEVEL_ONLY = False
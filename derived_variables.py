@@ -0,0 +1,107 @@
+"""
+
+Compute TEOS-10 variables from CTDPRS, CTDTMP and CTDSAL
+
+All profiles are computed in one pass on the (N_profile, N_level)
+arrays. LATITUDE and LONGITUDE of each profile are broadcast along
+N_level. Values are only computed where pressure, temperature and
+salinity all have an accepted flag, otherwise they are NaN.
+
+Uses the gsw package (Gibbs SeaWater toolbox), which is only needed
+when derived variables are requested.
+
+input: xarray dataset from process_folder and accepted flags
+output: xarray dataset with derived variables added
+
+"""
+
+import numpy as np
+import xarray as xr
+
+try:
+    import gsw
+except ImportError:
+    gsw = None
+
+from qc_flags import get_good_data_masks, get_profile_array
+
+
+DERIVED_ATTRIBUTES = {
+    'ABSOLUTE_SALINITY': {
+        'units': 'g kg-1',
+        'standard_name': 'sea_water_absolute_salinity',
+        'long_name': 'Absolute Salinity'
+    },
+    'CONSERVATIVE_TEMPERATURE': {
+        'units': 'degree_C',
+        'standard_name': 'sea_water_conservative_temperature',
+        'long_name': 'Conservative Temperature'
+    },
+    'POTENTIAL_TEMPERATURE': {
+        'units': 'degree_C',
+        'standard_name': 'sea_water_potential_temperature',
+        'long_name': 'Potential Temperature referenced to 0 dbar'
+    },
+    'SIGMA0': {
+        'units': 'kg m-3',
+        'standard_name': 'sea_water_sigma_theta',
+        'long_name': 'Potential Density Anomaly referenced to 0 dbar'
+    }
+}
+
+SOURCE_NAMES = ['CTDPRS', 'CTDTMP', 'CTDSAL']
+
+
+def get_derived_names():
+
+    return list(DERIVED_ATTRIBUTES)
+
+
+def compute_teos10_variables(ctd_xr, accepted_flags):
+
+    if gsw is None:
+        raise ImportError('The gsw package is needed to compute TEOS-10 variables')
+
+    missing = [name for name in SOURCE_NAMES if name not in ctd_xr]
+
+    if missing:
+        raise ValueError('Parameters needed for TEOS-10 variables are missing: {}'.format(', '.join(missing)))
+
+    # Only use levels where all source parameters are good
+    masks = get_good_data_masks(ctd_xr, SOURCE_NAMES, accepted_flags)
+
+    good = masks['CTDPRS'] & masks['CTDTMP'] & masks['CTDSAL']
+
+    pressure = np.where(good, get_profile_array(ctd_xr, 'CTDPRS'), np.nan)
+    temperature = np.where(good, get_profile_array(ctd_xr, 'CTDTMP'), np.nan)
+    practical_salinity = np.where(good, get_profile_array(ctd_xr, 'CTDSAL'), np.nan)
+
+    latitude = ctd_xr['LATITUDE'].values[:, np.newaxis]
+    longitude = ctd_xr['LONGITUDE'].values[:, np.newaxis]
+
+    absolute_salinity = gsw.SA_from_SP(practical_salinity, pressure, longitude, latitude)
+    conservative_temperature = gsw.CT_from_t(absolute_salinity, temperature, pressure)
+    potential_temperature = gsw.pt0_from_t(absolute_salinity, temperature, pressure)
+    sigma0 = gsw.sigma0(absolute_salinity, conservative_temperature)
+
+    return {
+        'ABSOLUTE_SALINITY': absolute_salinity,
+        'CONSERVATIVE_TEMPERATURE': conservative_temperature,
+        'POTENTIAL_TEMPERATURE': potential_temperature,
+        'SIGMA0': sigma0
+    }
+
+
+def add_derived_variables_to_xarray(ctd_xr, accepted_flags):
+
+    derived = compute_teos10_variables(ctd_xr, accepted_flags)
+
+    comment = 'Computed with TEOS-10 from {} with flags in {}'.format(', '.join(SOURCE_NAMES), list(accepted_flags))
+
+    for name, values in derived.items():
+
+        attrs = {**DERIVED_ATTRIBUTES[name], 'comment': comment}
+
+        ctd_xr[name] = xr.DataArray(values, dims=['N_profile', 'N_level'], attrs=attrs)
+
+    return ctd_xr
@@ -6,7 +6,8 @@ Metadata is from header of file
 Parameter is from parameter names and units lines of file
 Body is parameter names and data lines of file
 
-input: file list to process
+input: file list to process and optional projection of
+parameter names and pressure range to keep
 output: parsed into metadata and body dataframes along with lists
 of parameter names and units
 
@@ -21,11 +22,13 @@ import pandas as pd
 import datetime as dt
 
 
-def get_all_data(raw_files):
+def get_all_data(raw_files, parameters=None, pressure_range=None):
 
     metadata_all = []
     body_all = []
 
+    format_info = {}
+
     # Then extract metadata and body portion for all files
 
     is_first_file = True
@@ -43,19 +46,162 @@ def get_all_data(raw_files):
         # Get parameters from first file since all files will be the same
         if is_first_file:
 
-            parameter_names, parameter_units, end_parameter_line = get_parameter_content(file_content, end_metadata_line) 
+            file_parameter_names, file_parameter_units, end_parameter_line = get_parameter_content(file_content, end_metadata_line) 
+
+            # Only keep requested parameters and their flags
+            parameter_names = get_projected_parameters(file_parameter_names, parameters)
+            parameter_units = {name: file_parameter_units[name] for name in parameter_names}
 
             is_first_file = False
 
 
-        body_df = get_body_content(file_content, parameter_names, end_parameter_line)
+        body_df = get_body_content(file_content, file_parameter_names, end_parameter_line, parameter_names, pressure_range)
 
         body_all.append(body_df)
 
+        # Formats are from the values of all files
+        format_info = update_format_info(format_info, body_df)
+
 
         metadata_names = list(metadata_all[0])
 
-    return metadata_all, body_all, metadata_names, parameter_names, parameter_units
+    parameter_formats = get_parameter_formats(format_info)
+
+    return metadata_all, body_all, metadata_names, parameter_names, parameter_units, parameter_formats
+
+
+def get_data_dimensions(raw_files, parameters=None, pressure_range=None):
+
+    # Pre-pass over all files for streaming conversion. Only the
+    # metadata and the number of body rows of each file are kept
+    # so the output file can be sized before any body is stored.
+    metadata_all = []
+
+    n_level = 0
+
+    is_first_file = True
+
+    for datafile in raw_files:
+
+        file_content = get_file_content(datafile)
+
+        metadata_df, end_metadata_line = get_metadata_content(file_content)
+        metadata_all.append(metadata_df)
+
+        file_parameter_names, file_parameter_units, end_parameter_line = get_parameter_content(file_content, end_metadata_line)
+
+        # Get parameters from first file since all files will be the same
+        if is_first_file:
+
+            parameter_names = get_projected_parameters(file_parameter_names, parameters)
+            parameter_units = {name: file_parameter_units[name] for name in parameter_names}
+
+            is_first_file = False
+
+        body_size = get_body_size(file_content, file_parameter_names, end_parameter_line, pressure_range)
+
+        n_level = max(n_level, body_size)
+
+    metadata_names = list(metadata_all[0])
+
+    return metadata_all, metadata_names, parameter_names, parameter_units, n_level
+
+
+def get_file_header(datafile):
+
+    # Get the lines before NUMBER_HEADERS of one file. These are
+    # saved with the NetCDF file so exchange files can be written
+    # back from it.
+    file_content = get_file_content(datafile)
+
+    _, header_line_number = find_header_line(file_content)
+
+    return file_content[:header_line_number]
+
+
+def get_format_info(values):
+
+    # Get what is needed to make the C format of a column of values
+    # as strings: shortest and longest length including spaces, if
+    # any value has a decimal point and the most decimals found
+    if values.empty:
+        return None
+
+    stripped = values.str.strip()
+
+    lengths = values.str.len()
+
+    has_decimal = bool(stripped.str.contains('.', regex=False).any())
+
+    decimals = int(stripped.str.partition('.')[2].str.len().max()) if has_decimal else 0
+
+    return {'min_width': int(lengths.min()), 'max_width': int(lengths.max()), 'has_decimal': has_decimal, 'decimals': decimals}
+
+
+def merge_format_info(info, other_info):
+
+    # Combine format info of the same column from two files
+    if info is None:
+        return other_info
+
+    if other_info is None:
+        return info
+
+    return {
+        'min_width': min(info['min_width'], other_info['min_width']),
+        'max_width': max(info['max_width'], other_info['max_width']),
+        'has_decimal': info['has_decimal'] or other_info['has_decimal'],
+        'decimals': max(info['decimals'], other_info['decimals'])
+    }
+
+
+def update_format_info(format_info, body_df):
+
+    # Add the values of a file body to the format info of each column
+    for name in body_df.columns:
+        format_info[name] = merge_format_info(format_info.get(name), get_format_info(body_df[name]))
+
+    return format_info
+
+
+def get_parameter_formats(format_info):
+
+    # Columns without values in any file have no format
+    parameter_formats = {}
+
+    for name, info in format_info.items():
+
+        value_format = get_info_format(info)
+
+        if value_format:
+            parameter_formats[name] = value_format
+
+    return parameter_formats
+
+
+def get_info_format(info, keep_width=True):
+
+    # Get C format such as '%9.4f' for '   21.4571' or '%3d' for '  2'.
+    # Width is kept only when all values including spaces have the
+    # same length, otherwise values are written without padding.
+    if info is None:
+        return None
+
+    if keep_width and info['min_width'] == info['max_width']:
+        width = str(info['max_width'])
+    else:
+        width = ''
+
+    if info['has_decimal']:
+        return '%{}.{}f'.format(width, info['decimals'])
+
+    return '%{}d'.format(width)
+
+
+def get_value_format(values, keep_width=True):
+
+    # Get C format of a column of values as strings
+    return get_info_format(get_format_info(values), keep_width)
 
 
 def get_file_content(filename):
@@ -184,7 +330,25 @@ def get_parameter_content(file_content, end_metadata_line):
     return parameter_names, parameter_units, end_parameter_line
 
 
-def get_body_content(file_content, parameter_names, end_parameter_line):
+def get_projected_parameters(parameter_names, parameters):
+
+    # Keep parameters in file order. If a parameter has a flag
+    # column, keep the flag too. No parameters means keep all.
+    if not parameters:
+        return parameter_names
+
+    missing = [name for name in parameters if name not in parameter_names]
+
+    if missing:
+        raise ValueError('Parameters not in file: {}'.format(', '.join(missing)))
+
+    keep = set(parameters)
+    keep.update(name + '_FLAG_W' for name in parameters)
+
+    return [name for name in parameter_names if name in keep]
+
+
+def get_body_content(file_content, parameter_names, end_parameter_line, keep_names=None, pressure_range=None):
 
     # Body lines will include the parameter name line and then all
     # following data lines except the line containg 'END_DATA'
@@ -192,11 +356,32 @@ def get_body_content(file_content, parameter_names, end_parameter_line):
 
     main_body = file_content[end_parameter_line : end_body_line]
 
-    body_df = pd.DataFrame([line.split(',') for line in main_body])
+    if keep_names is None:
+        keep_names = parameter_names
+
+    # Only split out columns to keep and skip rows outside of
+    # the pressure range so they are never stored
+    keep_columns = [parameter_names.index(name) for name in keep_names]
+
+    if pressure_range:
+        min_pressure, max_pressure = pressure_range
+        pressure_column = parameter_names.index('CTDPRS')
 
+    body = []
 
-    # Add column names
-    body_df.columns = parameter_names
+    for line in main_body:
+
+        values = line.split(',')
+
+        if pressure_range:
+            pressure = float(values[pressure_column])
+            if pressure < min_pressure or pressure > max_pressure:
+                continue
+
+        body.append([values[column] for column in keep_columns])
+
+    # Create dataframe with column names
+    body_df = pd.DataFrame(body, columns=keep_names)
 
     # rename dataframe index (column name representing rows)
     body_df.index.names = ['N_level']
@@ -204,6 +389,32 @@ def get_body_content(file_content, parameter_names, end_parameter_line):
     return body_df
 
 
+def get_body_size(file_content, parameter_names, end_parameter_line, pressure_range=None):
+
+    # Number of body rows kept by get_body_content without
+    # splitting out any columns except pressure
+    end_body_line = find_end_body(file_content)
+
+    main_body = file_content[end_parameter_line : end_body_line]
+
+    if not pressure_range:
+        return len(main_body)
+
+    min_pressure, max_pressure = pressure_range
+    pressure_column = parameter_names.index('CTDPRS')
+
+    body_size = 0
+
+    for line in main_body:
+
+        pressure = float(line.split(',')[pressure_column])
+
+        if min_pressure <= pressure <= max_pressure:
+            body_size += 1
+
+    return body_size
+
+
 def find_end_body(file_content):
 
     # Find line starting with END_DATA
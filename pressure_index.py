@@ -0,0 +1,251 @@
+"""
+
+Per-profile pressure index for reading pressure ranges
+
+For each profile the converter saves
+
+  PROFILE_N_LEVEL     number of levels up to the last pressure value
+  PRESSURE_INDEX_MAX  running maximum of CTDPRS along the levels
+  PRESSURE_INDEX_MIN  running minimum of CTDPRS from the last level back
+
+Both index variables never decrease along the levels, even with
+pressure reversals, so a binary search gives the level slice holding
+every value in a pressure range. Levels before the first index with
+PRESSURE_INDEX_MAX >= min pressure are all shallower than the range and
+levels after the last index with PRESSURE_INDEX_MIN <= max pressure are
+all deeper. Missing pressures are stored as -inf and +inf in the index.
+
+The NetCDF file can use the padded (N_profile, N_level) layout or a
+CF contiguous ragged array layout, where the levels of all profiles
+are one after the other along N_obs and ROW_SIZE gives the number of
+levels of each profile. ROW_SIZE replaces PROFILE_N_LEVEL in this
+layout, PROFILE_ID has the cf_role profile_id and the featureType
+global attribute is profile.
+
+get_level_slices and read_pressure_range read only the index and the
+level slices of each profile from the file.
+
+"""
+
+import numpy as np
+import xarray as xr
+
+from qc_flags import get_profile_array
+
+
+INDEX_NAMES = ['PROFILE_N_LEVEL', 'PRESSURE_INDEX_MAX', 'PRESSURE_INDEX_MIN']
+
+
+def get_pressure_index(pressure):
+
+    # pressure has dimension order (N_profile, N_level)
+    is_missing = np.isnan(pressure)
+
+    index_max = np.maximum.accumulate(np.where(is_missing, -np.inf, pressure), axis=1)
+
+    reversed_pressure = np.where(is_missing, np.inf, pressure)[:, ::-1]
+    index_min = np.minimum.accumulate(reversed_pressure, axis=1)[:, ::-1]
+
+    # Number of levels is one past the last level with a pressure
+    n_level = pressure.shape[1]
+    has_pressure = ~is_missing
+
+    last_level = n_level - np.argmax(has_pressure[:, ::-1], axis=1)
+    profile_n_level = np.where(has_pressure.any(axis=1), last_level, 0).astype(np.int32)
+
+    return profile_n_level, index_max, index_min
+
+
+def add_pressure_index_to_xarray(ctd_xr):
+
+    profile_n_level, index_max, index_min = get_pressure_index(get_profile_array(ctd_xr, 'CTDPRS'))
+
+    units = ctd_xr['CTDPRS'].attrs.get('units', '')
+
+    ctd_xr['PROFILE_N_LEVEL'] = xr.DataArray(profile_n_level, dims=['N_profile'], attrs={'long_name': 'Number of levels in profile'})
+
+    # Index has the same dimension order as CTDPRS
+    dims = ctd_xr['CTDPRS'].dims
+
+    index_max_xr = xr.DataArray(index_max, dims=['N_profile', 'N_level'], attrs={'units': units, 'long_name': 'Running maximum of CTDPRS'})
+    ctd_xr['PRESSURE_INDEX_MAX'] = index_max_xr.transpose(*dims)
+
+    index_min_xr = xr.DataArray(index_min, dims=['N_profile', 'N_level'], attrs={'units': units, 'long_name': 'Running minimum of CTDPRS from the last level'})
+    ctd_xr['PRESSURE_INDEX_MIN'] = index_min_xr.transpose(*dims)
+
+    return ctd_xr
+
+
+def to_ragged_layout(ctd_xr):
+
+    # Keep only the PROFILE_N_LEVEL levels of each profile and put
+    # the levels of all profiles one after the other along N_obs
+    if 'PROFILE_N_LEVEL' not in ctd_xr:
+        raise ValueError('CTDPRS is needed to save a ragged layout')
+
+    profile_n_level = ctd_xr['PROFILE_N_LEVEL'].values
+
+    is_level = np.arange(ctd_xr.sizes['N_level']) < profile_n_level[:, np.newaxis]
+
+    # Variables along N_level only, such as STANDARD_LEVEL,
+    # are the same for all profiles and are kept as they are
+    profile_names = [name for name in ctd_xr.variables if {'N_profile', 'N_level'} <= set(ctd_xr[name].dims)]
+
+    # ROW_SIZE replaces PROFILE_N_LEVEL, they have the same values
+    ragged_xr = ctd_xr.drop(profile_names + ['PROFILE_N_LEVEL'])
+
+    for name in profile_names:
+
+        variable = ctd_xr[name]
+
+        other_dims = [dim for dim in variable.dims if dim not in ('N_profile', 'N_level')]
+
+        values = variable.transpose('N_profile', 'N_level', *other_dims).values[is_level]
+
+        ragged_xr[name] = xr.DataArray(values, dims=['N_obs'] + other_dims, attrs=variable.attrs)
+
+    ragged_xr['ROW_SIZE'] = xr.DataArray(profile_n_level, dims=['N_profile'], attrs={'long_name': 'Number of levels in profile', 'sample_dimension': 'N_obs'})
+
+    # CF discrete sampling geometry attributes
+    ragged_xr['PROFILE_ID'] = xr.DataArray(get_profile_ids(ctd_xr), dims=['N_profile'], attrs={'long_name': 'Profile identifier', 'cf_role': 'profile_id'})
+
+    ragged_xr.attrs = dict(ctd_xr.attrs, featureType='profile')
+
+    return ragged_xr
+
+
+def get_profile_ids(ctd_xr):
+
+    # Profile id of form <expocode>_<station id>_<cast number>,
+    # or the profile number if these metadata aren't in the dataset
+    id_names = [name for name in ['EXPOCODE', 'STNNBR', 'CASTNO'] if name in ctd_xr]
+
+    if not id_names:
+        return np.arange(ctd_xr.sizes['N_profile']).astype('S')
+
+    columns = []
+
+    for name in id_names:
+        columns.append([value.decode('utf-8').strip() if isinstance(value, bytes) else str(value) for value in ctd_xr[name].values])
+
+    return np.array(['_'.join(parts) for parts in zip(*columns)], dtype='S')
+
+
+def to_padded_layout(ctd_xr, fill_value):
+
+    # Reverse of to_ragged_layout
+    row_size = ctd_xr['ROW_SIZE'].values
+
+    n_level = int(row_size.max()) if row_size.size else 0
+
+    # Keep the size of N_level if variables along it were kept
+    n_level = max(n_level, ctd_xr.sizes.get('N_level', 0))
+
+    is_level = np.arange(n_level) < row_size[:, np.newaxis]
+
+    padded_xr = ctd_xr.drop([name for name in ctd_xr.variables if 'N_obs' in ctd_xr[name].dims] + ['ROW_SIZE'])
+
+    padded_xr['PROFILE_N_LEVEL'] = xr.DataArray(row_size.astype(np.int32), dims=['N_profile'], attrs={'long_name': 'Number of levels in profile'})
+
+    for name, variable in ctd_xr.variables.items():
+
+        if 'N_obs' not in variable.dims:
+            continue
+
+        other_dims = [dim for dim in variable.dims if dim != 'N_obs']
+
+        values = variable.transpose('N_obs', *other_dims).values
+
+        if values.dtype.kind == 'f':
+            fill = np.nan
+        elif 'FLAG' in name:
+            fill = fill_value['flag']
+        else:
+            fill = 0
+
+        padded = np.full((len(row_size), n_level) + values.shape[1:], fill, dtype=values.dtype)
+        padded[is_level] = values
+
+        padded_xr[name] = xr.DataArray(padded, dims=['N_profile', 'N_level'] + other_dims, attrs=variable.attrs)
+
+    return padded_xr
+
+
+def get_profile_bounds(ds):
+
+    # Get first and one past last level of each profile along the
+    # level dimension of the file, N_obs for ragged or N_level
+    if 'ROW_SIZE' in ds:
+        row_size = ds['ROW_SIZE'].values.astype(np.int64)
+        stop = np.cumsum(row_size)
+        start = stop - row_size
+    else:
+        stop = ds['PROFILE_N_LEVEL'].values.astype(np.int64)
+        start = np.zeros_like(stop)
+
+    return start, stop
+
+
+def get_level_slices(ds, min_pressure, max_pressure):
+
+    # Binary search the index of each profile for the levels
+    # holding all pressures from min_pressure to max_pressure.
+    # Slices are along N_obs for ragged files and along N_level
+    # for padded files.
+    profile_start, profile_stop = get_profile_bounds(ds)
+
+    level_slices = []
+
+    for profile, (start, stop) in enumerate(zip(profile_start, profile_stop)):
+
+        index_max = read_profile_slice(ds, 'PRESSURE_INDEX_MAX', profile, slice(start, stop))
+        index_min = read_profile_slice(ds, 'PRESSURE_INDEX_MIN', profile, slice(start, stop))
+
+        first = np.searchsorted(index_max, min_pressure, side='left')
+        last = np.searchsorted(index_min, max_pressure, side='right')
+
+        level_slices.append(slice(start + first, start + max(first, last)))
+
+    return level_slices
+
+
+def read_pressure_range(netcdf_filename, min_pressure, max_pressure, variables=None):
+
+    # Read values from min_pressure to max_pressure of each profile.
+    # Returns a dict of variable name to a list with an array of
+    # values for each profile. Only the index and the level slices
+    # are read from the file.
+    with xr.open_dataset(netcdf_filename) as ds:
+
+        # Default is all variables with levels for each profile
+        profile_dims = {'N_obs'} if 'ROW_SIZE' in ds else {'N_profile', 'N_level'}
+
+        if variables is None:
+            variables = [name for name in ds.data_vars if profile_dims <= set(ds[name].dims) and name not in INDEX_NAMES]
+
+        level_slices = get_level_slices(ds, min_pressure, max_pressure)
+
+        values = {name: [] for name in variables}
+
+        for profile, level_slice in enumerate(level_slices):
+
+            pressure = read_profile_slice(ds, 'CTDPRS', profile, level_slice)
+
+            # Drop levels in the slice outside of the range from
+            # pressure reversals
+            keep = (pressure >= min_pressure) & (pressure <= max_pressure)
+
+            for name in variables:
+                values[name].append(read_profile_slice(ds, name, profile, level_slice)[keep])
+
+    return values
+
+
+def read_profile_slice(ds, name, profile, level_slice):
+
+    # Read the levels of one profile. In ragged files the
+    # slice is already along N_obs for that profile.
+    if 'ROW_SIZE' in ds:
+        return ds[name][level_slice].values
+
+    return ds[name].transpose('N_profile', 'N_level', ...)[profile, level_slice].values
@@ -49,6 +49,8 @@ belong in data.
 """
 
 from pathlib import Path
+import os
+import re
 import numpy as np
 import scipy.io as sio
 import pandas as pd
@@ -59,7 +61,13 @@ import json
 from config import Config
 
 from get_files import get_sorted_files
-from get_data import get_all_data
+from get_data import get_all_data, get_data_dimensions, get_file_header, get_value_format
+from standard_levels import create_standard_level_dataset
+from qc_flags import get_flag_names, fill_missing_flags, get_good_data_masks, add_masked_parameters_to_xarray, compact_flags
+from stream_netcdf import stream_files_to_netcdf
+from derived_variables import add_derived_variables_to_xarray, get_derived_names
+from utilities.write_mat_v73 import write_mat_v73
+from pressure_index import add_pressure_index_to_xarray, to_ragged_layout
 
 
 # Read in all files in the raw folder, sort, and then 
@@ -81,6 +89,10 @@ def create_folders():
     # Create output directory for netcdf file
     Config.NETCDF_DIR.mkdir(parents=True, exist_ok=True)
 
+    # Create output directory for mat file
+    if Config.SAVE_MAT:
+        Config.MAT_DIR.mkdir(parents=True, exist_ok=True)
+
 
 def process_folder(raw_dir):
 
@@ -89,11 +101,13 @@ def process_folder(raw_dir):
     raw_files = get_sorted_files(raw_dir, Config.SORT_ROUTINE)
 
     # Get data from files and parse into dataframes and lists
-    metadata_all, body_all, metadata_names, parameter_names, parameter_units = get_all_data(raw_files)
+    # Only requested parameters and pressure range are kept.
+    # Parameter formats are from the values of all files.
+    metadata_all, body_all, metadata_names, parameter_names, parameter_units, parameter_formats = get_all_data(raw_files, Config.PARAMETERS, Config.PRESSURE_RANGE)
 
 
     # Get metadata and parameter data types
-    metadata_dtypes = get_metadata_dtypes(metadata_names)
+    metadata_dtypes = get_metadata_dtypes(metadata_names, metadata_all)
     parameter_dtypes = get_parameter_dtypes(parameter_units)
 
 
@@ -110,6 +124,10 @@ def process_folder(raw_dir):
     # Gather metadata data frame as a data series
     metadata_ds = get_metadata_data_series(metadata_all, metadata_names, metadata_dtypes)
 
+    # Get formats of values in files to write exchange files back
+    metadata_formats = get_metadata_formats(metadata_all, metadata_names, metadata_dtypes)
+    file_header = get_file_header(raw_files[0])
+
     # Merge body and metadata into one xarray
     ctd_xr = add_body_and_metadata_to_xarray_dataset(body_all, parameter_names, parameter_dtypes, fill_value, metadata_names, metadata_ds)
 
@@ -121,56 +139,186 @@ def process_folder(raw_dir):
     metadata_attributes = get_metadata_attributes(metadata_attributes_file)
 
     # Add NetCDF attributes to xarray
-    ctd_xr = add_metadata_attributes_to_xarray(metadata_attributes, metadata_names, ctd_xr)
+    ctd_xr = add_metadata_attributes_to_xarray(metadata_attributes, metadata_names, metadata_formats, ctd_xr)
 
-    ctd_xr = add_parameter_attributes_to_xarray(parameter_units, ctd_xr, fill_value)
+    ctd_xr = add_parameter_attributes_to_xarray(parameter_units, parameter_formats, ctd_xr, fill_value)
 
 
     # Get metadata attributes
     global_attributes_file = './global_attributes.csv'
     global_attributes = get_global_attributes(global_attributes_file)
 
+    # Keep lines before NUMBER_HEADERS for writing exchange files
+    global_attributes['exchange_header'] = '\n'.join(file_header)
+
     ctd_xr = add_global_attributes_to_xarray(global_attributes, ctd_xr)
+
+
+    # Names of variables to put on standard levels
+    level_names = parameter_names
+
+    if Config.DERIVE_TEOS10:
+
+        print('Compute TEOS-10 variables')
+        # Compute derived variables for all profiles at once
+        ctd_xr = add_derived_variables_to_xarray(ctd_xr, Config.ACCEPTED_FLAGS)
+
+        level_names = parameter_names + get_derived_names()
  
     print(ctd_xr)
 
 
-    print('Save as NetCDF')
-    # Convert xarray to NetCDF format and save
-    save_as_netcdf(ctd_xr, metadata_encoding)
+    if Config.SAVE_MAT:
+
+        print('Save as Mat')
+        # Convert xarray arrays to mat format and save
+        save_as_mat(ctd_xr)
+
+
+    if Config.STANDARD_LEVEL_METHOD:
+
+        print('Create standard levels')
+        # Bin or interpolate all profiles onto standard pressure levels
+        std_xr = create_standard_level_dataset(ctd_xr, level_names, Config.STANDARD_LEVEL_METHOD, Config.STANDARD_LEVEL_INTERVAL, Config.STANDARD_LEVELS, Config.ACCEPTED_FLAGS, fill_value)
+
+        print('Save standard levels as NetCDF')
+        std_xr = compact_flags(std_xr, get_flag_names(parameter_names), Config.FLAG_STORAGE, fill_value)
+        std_xr = set_netcdf_layout(std_xr)
+        save_as_netcdf(std_xr, metadata_encoding, suffix='_std_levels')
+
+
+    if not (Config.STANDARD_LEVEL_METHOD and Config.STANDARD_LEVEL_ONLY):
+
+        if Config.WRITE_MASKED_PARAMETERS:
+            # Add parameters with values not having an accepted flag set to NaN
+            data_names = [name for name in parameter_names if 'FLAG' not in name]
+            masks = get_good_data_masks(ctd_xr, data_names, Config.ACCEPTED_FLAGS)
+            ctd_xr = add_masked_parameters_to_xarray(ctd_xr, masks, Config.ACCEPTED_FLAGS)
+
+        # Store flags as separate variables, a flag matrix or packed flags
+        ctd_xr = compact_flags(ctd_xr, get_flag_names(parameter_names), Config.FLAG_STORAGE, fill_value)
+
+        # Add pressure index and use a padded or ragged layout
+        ctd_xr = set_netcdf_layout(ctd_xr)
+
+        print('Save as NetCDF')
+        # Convert xarray to NetCDF format and save
+        save_as_netcdf(ctd_xr, metadata_encoding)
+
+    # Dataset can be passed to write_exchange.write_exchange_files
+    return ctd_xr
+
+
+def process_folder_streaming(raw_dir):
+
+    # Convert one cast at a time into a NetCDF file sized by a
+    # pre-pass so only one cast is held in memory. Derived variables,
+    # standard levels, masked parameters, compact flags and the mat
+    # file need all casts at once and are not made in this mode.
+
+    print('Get data dimensions')
+    # Get sorted list of files in exchange ctd format to convert
+    raw_files = get_sorted_files(raw_dir, Config.SORT_ROUTINE)
+
+    # Get metadata of all files and the largest number of body rows
+    metadata_all, metadata_names, parameter_names, parameter_units, n_level = get_data_dimensions(raw_files, Config.PARAMETERS, Config.PRESSURE_RANGE)
+
+
+    # Get metadata and parameter data types
+    metadata_dtypes = get_metadata_dtypes(metadata_names, metadata_all)
+    parameter_dtypes = get_parameter_dtypes(parameter_units)
+
+    fill_value = {'flag': 9, 'datetime': np.datetime64('NaT')}
+
+    # Gather metadata data frame as a data series
+    metadata_ds = get_metadata_data_series(metadata_all, metadata_names, metadata_dtypes)
+
+    # Get formats of values in files to write exchange files back.
+    # Parameter formats are set while the casts are streamed.
+    metadata_formats = get_metadata_formats(metadata_all, metadata_names, metadata_dtypes)
+    file_header = get_file_header(raw_files[0])
+
+    # Get attributes
+    metadata_attributes_file = './metadata_attributes.csv'
+    metadata_attributes = get_metadata_attributes(metadata_attributes_file)
+    metadata_attributes = get_metadata_variable_attributes(metadata_attributes, metadata_names, metadata_formats)
+
+    parameter_attributes = get_parameter_variable_attributes(parameter_units, {}, fill_value)
+
+    global_attributes_file = './global_attributes.csv'
+    global_attributes = get_global_attributes(global_attributes_file)
+
+    global_attributes['exchange_header'] = '\n'.join(file_header)
+
+
+    print('Stream casts to NetCDF')
+    expocode = get_metadata_string(metadata_ds['EXPOCODE'][0])
 
-    #print('Save as Mat')
-    # Convert NetCDF format to mat format and save
-    #save_as_mat(ctd_xr)
+    netcdf_filename = get_netcdf_filename(expocode)
 
+    stream_files_to_netcdf(raw_files, netcdf_filename, n_level, metadata_ds, metadata_attributes, parameter_names, parameter_dtypes, parameter_attributes, global_attributes, Config.PRESSURE_RANGE)
 
-def get_metadata_dtypes(metadata_names):
+
+def get_metadata_dtypes(metadata_names, metadata_all):
     
     metadata_dtypes = {}
 
+    df = pd.concat(metadata_all)
+
     # iterate through metadata and set dtype
-    # dtype is object (string) by default
+    # dtype is from the values if not set by name
     for name in metadata_names:
  
-        metadata_dtypes[name] = object
+        if name in ['LATITUDE', 'LONGITUDE', 'DEPTH', 'SECS_FROM_1970']:
+            metadata_dtypes[name] = np.dtype(np.float64)
 
-        if name == 'LATITUDE':
-            metadata_dtypes[name] = np.float64
+        elif name == 'DATETIME':
+            metadata_dtypes[name] = np.dtype('datetime64[ns]')
+
+        else:
+            metadata_dtypes[name] = get_metadata_value_dtype(df[name].astype(str))
 
-        if name == 'LONGITUDE':
-            metadata_dtypes[name] = np.float64
 
-        if name == 'DEPTH':
-            metadata_dtypes[name] = np.float64
+    return metadata_dtypes
 
-        if name == 'DATETIME':
-            metadata_dtypes[name] = np.datetime64
 
-        if name == 'SECS_FROM_1970':
-            metadata_dtypes[name] = np.float64      
+def get_metadata_value_dtype(values):
 
+    # Metadata is stored as a number if writing the number back
+    # gives the same string, so STNNBR = 12 is an int32 but
+    # TIME = 0930 is not. Otherwise store as fixed width bytes
+    # instead of python string objects, such as S12 for EXPOCODE.
+    value_format = get_value_format(values, keep_width=False)
+
+    try:
+        numbers = values.astype(np.float64)
+    except ValueError:
+        numbers = None
+
+    if numbers is not None and numbers.notnull().all():
+
+        if value_format.endswith('d'):
+            is_valid = (numbers.abs() < 2**31).all() and all(value_format % number == value for number, value in zip(numbers, values))
+            number_dtype = np.int32
+        else:
+            is_valid = all(value_format % number == value for number, value in zip(numbers, values))
+            number_dtype = np.float64
+
+        if is_valid:
+            return np.dtype(number_dtype)
+
+    width = max(values.str.encode('utf-8').str.len().max(), 1)
+
+    return np.dtype('S{}'.format(width))
 
-    return metadata_dtypes
+
+def get_metadata_string(value):
+
+    # Metadata strings are stored as bytes
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+
+    return str(value)
 
 
 def set_metadata_encoding(metadata_names): 
@@ -231,11 +379,31 @@ def get_metadata_data_series(metadata_all, metadata_names, metadata_dtypes):
 
         # Apply dtypes to variables
         md_name_dtype = metadata_dtypes[md_name]
-        metadata_ds[md_name] = series.astype(md_name_dtype)
+
+        if md_name_dtype.kind == 'S':
+            metadata_ds[md_name] = series.str.encode('utf-8').values.astype(md_name_dtype)
+        else:
+            metadata_ds[md_name] = series.astype(md_name_dtype).values
 
     return metadata_ds
 
 
+def get_metadata_formats(metadata_all, metadata_names, metadata_dtypes):
+
+    # Get C format of float metadata, such as '%.4f' for LATITUDE,
+    # from the values as strings in all file headers
+    metadata_formats = {}
+
+    df = pd.concat(metadata_all)
+
+    for md_name in metadata_names:
+
+        if metadata_dtypes[md_name] == np.float64:
+            metadata_formats[md_name] = get_value_format(df[md_name].astype(str), keep_width=False)
+
+    return metadata_formats
+
+
 def add_body_and_metadata_to_xarray_dataset(body_all, parameter_names, parameter_dtypes, fill_value, metadata_names, metadata_ds):
 
     # index column of each body dataframe was renamed 'N_level'
@@ -249,9 +417,7 @@ def add_body_and_metadata_to_xarray_dataset(body_all, parameter_names, parameter
     ctd_pd = ctd_xr.to_dataframe()
 
     # Fill NaN values in qc flags with an interger fill value
-    for name in parameter_names:
-        if 'FLAG' in name and parameter_dtypes[name] == np.int8:
-            ctd_pd.loc[ctd_pd[name].isnull(), [name]] = fill_value['flag']
+    ctd_pd = fill_missing_flags(ctd_pd, get_flag_names(parameter_names), fill_value)
 
     # Assign data types
     ctd_pd = ctd_pd.astype(parameter_dtypes)
@@ -268,7 +434,7 @@ def add_body_and_metadata_to_xarray_dataset(body_all, parameter_names, parameter
 
     for md_name in metadata_names_reversed:
 
-        name_xr = metadata_ds[md_name].to_xarray()
+        name_xr = xr.DataArray(metadata_ds[md_name], dims=['index'], name=md_name)
 
         ctd_xr = xr.merge([name_xr, ctd_xr])
 
@@ -292,9 +458,7 @@ def add_body_and_metadata_to_xarray_dataset2(body_all, parameter_names, paramete
     ctd_pd = ctd_xr.to_dataframe()
 
     # Fill NaN values in qc flags with an interger fill value
-    for name in parameter_names:
-        if 'FLAG' in name and parameter_dtypes[name] == np.int8:
-            ctd_pd.loc[ctd_pd[name].isnull(), [name]] = fill_value['flag']
+    ctd_pd = fill_missing_flags(ctd_pd, get_flag_names(parameter_names), fill_value)
 
     # Assign data types
     ctd_pd = ctd_pd.astype(parameter_dtypes)
@@ -324,7 +488,7 @@ def add_body_and_metadata_to_xarray_dataset2(body_all, parameter_names, paramete
 
         meta_data = metadata_ds[md_name].T
 
-        metadata_dict[md_name] = xr.DataArray(meta_data, dims=['N_profile'])
+        metadata_dict[md_name] = xr.DataArray(meta_data, dims=['N_profile'], name=md_name)
 
 
     # Add data arrays to ctd_xr
@@ -363,7 +527,9 @@ def get_metadata_attributes(attribute_file):
     return json_data
 
 
-def add_metadata_attributes_to_xarray(attributes, metadata_names, ctd_xr):
+def get_metadata_variable_attributes(attributes, metadata_names, metadata_formats):
+
+    variable_attributes = {}
 
     for attribute in attributes:
 
@@ -413,21 +579,53 @@ def add_metadata_attributes_to_xarray(attributes, metadata_names, ctd_xr):
             #     data_attributes = {**data_attributes, **data_attr}
 
 
-            ctd_xr[attribute['variable']].attrs = data_attributes
+            variable_attributes[attribute['variable']] = data_attributes
+
 
+    for name, value_format in metadata_formats.items():
 
+        variable_attributes.setdefault(name, {})['C_format'] = value_format
+
+
+    return variable_attributes
+
+
+def add_metadata_attributes_to_xarray(attributes, metadata_names, metadata_formats, ctd_xr):
+
+    variable_attributes = get_metadata_variable_attributes(attributes, metadata_names, metadata_formats)
+
+    for name, data_attributes in variable_attributes.items():
+
+        ctd_xr[name].attrs = data_attributes
 
     return ctd_xr
 
 
-def add_parameter_attributes_to_xarray(parameter_units, ctd_xr, fill_value):
+def get_parameter_variable_attributes(parameter_units, parameter_formats, fill_value):
+
+    variable_attributes = {}
 
     for name in parameter_units:
 
         if 'FLAG' in name:
-            ctd_xr[name].attrs = {'_FillValue': fill_value['flag']} 
+            variable_attributes[name] = {'_FillValue': fill_value['flag']} 
         else:
-            ctd_xr[name].attrs = {'units': parameter_units[name]} 
+            variable_attributes[name] = {'units': parameter_units[name]} 
+
+        # C format of values in the exchange file
+        if name in parameter_formats:
+            variable_attributes[name]['C_format'] = parameter_formats[name]
+
+    return variable_attributes
+
+
+def add_parameter_attributes_to_xarray(parameter_units, parameter_formats, ctd_xr, fill_value):
+
+    variable_attributes = get_parameter_variable_attributes(parameter_units, parameter_formats, fill_value)
+
+    for name, data_attributes in variable_attributes.items():
+
+        ctd_xr[name].attrs = data_attributes
 
     return ctd_xr
 
@@ -454,16 +652,33 @@ def add_global_attributes_to_xarray(attributes, ctd_xr):
     return ctd_xr
 
 
-def save_as_netcdf(ctd_xr, metadata_encoding):
+def set_netcdf_layout(ctd_xr):
+
+    # Pressure index is used to read pressure ranges of each profile
+    if 'CTDPRS' in ctd_xr:
+        ctd_xr = add_pressure_index_to_xarray(ctd_xr)
+
+    if Config.NETCDF_LAYOUT == 'ragged':
+        ctd_xr = to_ragged_layout(ctd_xr)
+
+    return ctd_xr
+
+
+def get_netcdf_filename(expocode, suffix=''):
+
+    filename = expocode + suffix + '.nc'
+
+    return Config.NETCDF_DIR.joinpath(filename)
+
+
+def save_as_netcdf(ctd_xr, metadata_encoding, suffix=''):
 
     # Save xarray as netcdf
 
     # Get expocode to include in filename
-    expocode = str(ctd_xr['EXPOCODE'][0].values)
-
-    filename = expocode + '.nc'
+    expocode = get_metadata_string(ctd_xr['EXPOCODE'].values[0])
 
-    netcdf_filename = Config.NETCDF_DIR.joinpath(filename)
+    netcdf_filename = get_netcdf_filename(expocode, suffix)
 
     try:
         os.remove(netcdf_filename)
@@ -480,52 +695,126 @@ def save_as_netcdf(ctd_xr, metadata_encoding):
     ctd_xr.to_netcdf(netcdf_filename, encoding=metadata_encoding)
 
 
-# def save_as_mat(ctd_xr):
+def save_as_mat(ctd_xr):
+
+    # Save arrays straight from the xarray variables without
+    # converting to python lists. Use a compressed v5 mat file
+    # unless a variable is too big for v5, then use v7.3 (HDF5).
+
+    # Get expocode to include in filename
+    expocode = get_metadata_string(ctd_xr['EXPOCODE'].values[0])
 
-#     # Get expocode to include in filename
-#     expocode = ctd_xr['EXPOCODE'][0].values[0]
+    filename = expocode + '.mat'
 
-#     filename = expocode + '.mat'
+    mat_filename = Config.MAT_DIR.joinpath(filename)
 
-#     mat_filename = Config.MAT_DIR.joinpath(filename)
+    try:
+        os.remove(mat_filename)
+    except:
+        pass
 
-#     try:
-#         os.remove(mat_filename)
-#     except:
-#         pass
 
+    mat_dict = get_mat_variables(ctd_xr)
 
-#     ctd_dict = ctd_xr.to_dict()
+    # v5 mat files can't hold variables of 2 GB or more
+    max_v5_bytes = 2**31 - 1
 
-#     #print(ctd_dict['data_vars']['CTDFLUOR'])
+    is_too_big = any(value.nbytes >= max_v5_bytes for value in mat_dict.values() if isinstance(value, np.ndarray))
 
-#     # {'data': [[values]], 'dims': ('N_profile', 'N_level'), 'attrs': {'units': 'MG/M^3'}}
+    if is_too_big:
+        write_mat_v73(mat_filename, mat_dict)
+    else:
+        sio.savemat(mat_filename, mat_dict, do_compression=True, long_field_names=True)
 
-#     ctd_fluor = ctd_dict['data_vars']['CTDFLUOR']
 
-#     ctd_fluor_data = ctd_fluor['data']
+def get_mat_variables(ctd_xr):
 
-#     N_profile = len(ctd_fluor_data)
-#     N_level = len(ctd_fluor_data[0])
+    # Get all metadata and parameter variables as numpy arrays
+    # with names allowed in MATLAB, plus structs of units and
+    # global attributes
+    mat_dict = {}
+    units = {}
 
-#     #print(N_profile, N_level)
+    for name, variable in ctd_xr.variables.items():
 
-#     ctd_fluor_units = ctd_fluor['attrs']['units']
+        if name in ctd_xr.dims:
+            continue
 
-#     #print(ctd_fluor_units)
+        mat_name = get_mat_name(name)
 
+        values = variable.values
 
+        if np.issubdtype(values.dtype, np.datetime64):
+            # Save datetime as MATLAB datenum, days since year 0
+            values = (values - np.datetime64('1970-01-01T00:00:00')) / np.timedelta64(1, 'D') + 719529.0
+            units[mat_name] = 'MATLAB datenum'
 
-#     sio.savemat( mat_filename, dict( [ ('CTDFLUOR', ctd_fluor_data), ('units', ctd_fluor_units) ] ) ) 
+        elif values.dtype.kind in ('O', 'S'):
+            # Save strings as a char matrix
+            values = np.array([item.decode('utf-8') if isinstance(item, bytes) else str(item) for item in values.ravel()])
 
+        elif 'units' in variable.attrs:
+            units[mat_name] = str(variable.attrs['units'])
 
+        mat_dict[mat_name] = values
+
+    mat_dict['units'] = units
+
+    mat_dict['global_attributes'] = {get_mat_name(name): str(value) for name, value in ctd_xr.attrs.items()}
+
+    return mat_dict
+
+
+def get_mat_name(name):
+
+    # MATLAB names are letters, numbers and underscores
+    # and start with a letter
+    mat_name = re.sub(r'\W', '_', name)
+
+    if not mat_name[0].isalpha():
+        mat_name = 'x' + mat_name
+
+    return mat_name
+
+
+def check_streaming_config():
+
+    # Settings that need all casts in memory can't be used
+    # when streaming
+    if not Config.STREAMING:
+        return
+
+    unsupported = []
+
+    if Config.DERIVE_TEOS10:
+        unsupported.append('DERIVE_TEOS10')
+    if Config.STANDARD_LEVEL_METHOD:
+        unsupported.append('STANDARD_LEVEL_METHOD')
+    if Config.STANDARD_LEVEL_ONLY:
+        unsupported.append('STANDARD_LEVEL_ONLY')
+    if Config.WRITE_MASKED_PARAMETERS:
+        unsupported.append('WRITE_MASKED_PARAMETERS')
+    if Config.FLAG_STORAGE != 'variables':
+        unsupported.append('FLAG_STORAGE')
+    if Config.NETCDF_LAYOUT != 'padded':
+        unsupported.append('NETCDF_LAYOUT')
+    if Config.SAVE_MAT:
+        unsupported.append('SAVE_MAT')
+
+    if unsupported:
+        raise ValueError('Not supported with STREAMING: {}'.format(', '.join(unsupported)))
 
 
 def main():
 
+    check_streaming_config()
+
     create_folders()
 
-    process_folder(Config.RAW_DIR)
+    if Config.STREAMING:
+        process_folder_streaming(Config.RAW_DIR)
+    else:
+        process_folder(Config.RAW_DIR)
 
     
 
@@ -0,0 +1,154 @@
+"""
+
+Process WOCE quality flags of all parameters at once
+
+Flag columns are the parameter names containing FLAG, for example
+CTDTMP_FLAG_W is the flag of CTDTMP. Instead of handling one flag
+column at a time, all flags are stacked into one array of dimension
+(N_flag, N_profile, N_level) so filling and testing them is done
+in one operation.
+
+Flags can be saved as separate variables (default), as one flag
+matrix variable QC_FLAGS of dimension (N_profile, N_level, N_flag)
+or packed two flags per byte in QC_FLAGS_PACKED. WOCE flags are 0 to 9
+so each flag fits in 4 bits. The attribute flag_variables lists the
+flag names in the order they are stored and flag_formats their
+C formats.
+
+"""
+
+import numpy as np
+import xarray as xr
+
+
+def get_flag_names(parameter_names):
+
+    return [name for name in parameter_names if 'FLAG' in name]
+
+
+def fill_missing_flags(ctd_pd, flag_names, fill_value):
+
+    # Fill NaN values in all qc flag columns with an integer fill value
+    if flag_names:
+        ctd_pd[flag_names] = ctd_pd[flag_names].fillna(fill_value['flag'])
+
+    return ctd_pd
+
+
+def get_profile_array(ctd_xr, name):
+
+    # Get values with dimension order (N_profile, N_level)
+    return ctd_xr[name].transpose('N_profile', 'N_level').values
+
+
+def get_good_data_masks(ctd_xr, parameter_names, accepted_flags):
+
+    # A value is good if it is a number and, when the parameter
+    # has a flag column, the flag is in the accepted flags.
+    # Flags of all parameters are tested with one np.isin call
+    masks = {}
+
+    flagged_names = [name for name in parameter_names if name + '_FLAG_W' in ctd_xr]
+
+    if flagged_names:
+        flags = np.stack([get_profile_array(ctd_xr, name + '_FLAG_W') for name in flagged_names])
+        accepted = np.isin(flags, accepted_flags)
+
+    for name in parameter_names:
+
+        good = np.isfinite(get_profile_array(ctd_xr, name))
+
+        if name in flagged_names:
+            good &= accepted[flagged_names.index(name)]
+
+        masks[name] = good
+
+    return masks
+
+
+def add_masked_parameters_to_xarray(ctd_xr, masks, accepted_flags):
+
+    # Add a copy of each parameter with values not having
+    # an accepted flag set to NaN
+    for name, good in masks.items():
+
+        values = get_profile_array(ctd_xr, name)
+
+        attrs = dict(ctd_xr[name].attrs)
+        attrs.pop('C_format', None)
+        attrs['comment'] = 'Values with flags not in {} set to NaN'.format(list(accepted_flags))
+
+        masked = np.where(good, values, np.nan)
+
+        ctd_xr[name + '_MASKED'] = xr.DataArray(masked, dims=['N_profile', 'N_level'], attrs=attrs)
+
+    return ctd_xr
+
+
+def get_flag_matrix(ctd_xr, flag_names):
+
+    # Stack flags into dimension order (N_profile, N_level, N_flag)
+    flags = [get_profile_array(ctd_xr, name) for name in flag_names]
+
+    return np.stack(flags, axis=-1).astype(np.int8)
+
+
+def pack_flags(flag_matrix, fill_value):
+
+    # Pack two flags into each byte, the first flag in the high
+    # 4 bits and the second in the low 4 bits. With an odd number
+    # of flags, the last byte is padded with the fill value
+    n_flag = flag_matrix.shape[-1]
+
+    if n_flag % 2:
+        pad = np.full(flag_matrix.shape[:-1] + (1,), fill_value['flag'], dtype=flag_matrix.dtype)
+        flag_matrix = np.concatenate([flag_matrix, pad], axis=-1)
+
+    flags = flag_matrix.astype(np.uint8)
+
+    return (flags[..., 0::2] << 4) | flags[..., 1::2]
+
+
+def unpack_flags(packed_flags, n_flag):
+
+    # Reverse of pack_flags
+    packed_flags = np.asarray(packed_flags, dtype=np.uint8)
+
+    flags = np.empty(packed_flags.shape[:-1] + (2 * packed_flags.shape[-1],), dtype=np.int8)
+
+    flags[..., 0::2] = packed_flags >> 4
+    flags[..., 1::2] = packed_flags & 0x0F
+
+    return flags[..., :n_flag]
+
+
+def compact_flags(ctd_xr, flag_names, storage, fill_value):
+
+    # Replace separate flag variables with one flag matrix
+    # variable or with packed flags
+    if storage == 'variables' or not flag_names:
+        return ctd_xr
+
+    flag_matrix = get_flag_matrix(ctd_xr, flag_names)
+
+    attrs = {'flag_variables': ' '.join(flag_names)}
+
+    # Keep flag formats for writing exchange files
+    flag_formats = [ctd_xr[name].attrs.get('C_format', '%d') for name in flag_names]
+    attrs['flag_formats'] = ' '.join(flag_formats)
+
+    if storage == 'matrix':
+        attrs['_FillValue'] = fill_value['flag']
+        ctd_xr['QC_FLAGS'] = xr.DataArray(flag_matrix, dims=['N_profile', 'N_level', 'N_flag'], attrs=attrs)
+
+    elif storage == 'packed':
+        attrs['comment'] = 'Two WOCE flags per byte, first flag in the high 4 bits'
+        packed = pack_flags(flag_matrix, fill_value)
+        ctd_xr['QC_FLAGS_PACKED'] = xr.DataArray(packed, dims=['N_profile', 'N_level', 'N_flag_byte'], attrs=attrs)
+
+    else:
+        raise ValueError("Flag storage must be 'variables', 'matrix' or 'packed'")
+
+    ctd_xr = ctd_xr.drop(flag_names)
+
+    return ctd_xr
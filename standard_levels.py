@@ -0,0 +1,266 @@
+"""
+
+Bin or interpolate profiles onto standard pressure levels
+
+Works on the assembled xarray dataset with parameter arrays of
+dimension (N_profile, N_level). Every parameter is binned or
+interpolated for all profiles at once instead of looping over
+each profile.
+
+Only values with an accepted QC flag are used. The standard level
+dataset has the same metadata as the raw dataset and an N_level
+dimension which is the number of standard levels. The pressure of
+each level is saved in STANDARD_LEVEL(N_level).
+
+input: xarray dataset from process_folder, parameter names and
+standard level settings
+output: xarray dataset on standard pressure levels
+
+"""
+
+import numpy as np
+import xarray as xr
+
+from qc_flags import get_good_data_masks, get_profile_array
+
+
+def get_standard_levels(ctd_xr, interval, levels):
+
+    # Use the custom list of levels if given, otherwise
+    # create levels every interval dbar from the surface
+    # to the deepest pressure of the cruise
+    if levels is not None and len(levels):
+        return np.asarray(levels, dtype=np.float64)
+
+    max_pressure = np.nanmax(ctd_xr['CTDPRS'].values)
+
+    return np.arange(0, max_pressure + interval, interval, dtype=np.float64)
+
+
+def get_bin_edges(levels):
+
+    # Bin edges are half way between the standard levels and
+    # the outer edges are half a level spacing past the first
+    # and last levels
+    if len(levels) < 2:
+        raise ValueError('At least two standard levels are needed')
+
+    midpoints = (levels[:-1] + levels[1:]) / 2
+
+    first_edge = levels[0] - (levels[1] - levels[0]) / 2
+    last_edge = levels[-1] + (levels[-1] - levels[-2]) / 2
+
+    return np.concatenate([[first_edge], midpoints, [last_edge]])
+
+
+def bin_parameters(ctd_xr, parameter_names, levels, masks):
+
+    # Average all values falling into each standard level bin.
+    # The bin of every value is found at once and the sums for
+    # all profiles are made with one bincount over a flattened
+    # (profile, bin) index
+    edges = get_bin_edges(levels)
+
+    n_profile = ctd_xr.sizes['N_profile']
+    n_bin = len(levels)
+
+    pressure = get_profile_array(ctd_xr, 'CTDPRS')
+    pressure_good = masks['CTDPRS']
+
+    bin_index = np.digitize(pressure, edges) - 1
+    in_range = pressure_good & (bin_index >= 0) & (bin_index < n_bin)
+
+    profile_index = np.arange(n_profile)[:, np.newaxis]
+    flat_index = profile_index * n_bin + bin_index
+
+    binned = {}
+    bin_flags = {}
+
+    for name in parameter_names:
+
+        if name == 'CTDPRS':
+            continue
+
+        good = in_range & masks[name]
+
+        values = get_profile_array(ctd_xr, name)
+
+        sums = np.bincount(flat_index[good], weights=values[good], minlength=n_profile * n_bin)
+        counts = np.bincount(flat_index[good], minlength=n_profile * n_bin)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sums / counts
+
+        binned[name] = mean.reshape(n_profile, n_bin)
+
+        if name + '_FLAG_W' in ctd_xr:
+            bin_flags[name] = get_bin_flags(ctd_xr, name, flat_index, good, n_profile, n_bin)
+
+    # Pressure is the standard level where a profile has data in the bin
+    counts = np.bincount(flat_index[in_range], minlength=n_profile * n_bin)
+    has_data = counts.reshape(n_profile, n_bin) > 0
+
+    binned['CTDPRS'] = np.where(has_data, levels, np.nan)
+
+    if 'CTDPRS_FLAG_W' in ctd_xr:
+        bin_flags['CTDPRS'] = get_bin_flags(ctd_xr, 'CTDPRS', flat_index, in_range, n_profile, n_bin)
+
+    return binned, bin_flags
+
+
+def get_bin_flags(ctd_xr, name, flat_index, good, n_profile, n_bin):
+
+    # Worst (largest) flag of the values averaged in each bin
+    flags = get_profile_array(ctd_xr, name + '_FLAG_W').astype(np.int8)
+
+    worst = np.zeros(n_profile * n_bin, dtype=np.int8)
+    np.maximum.at(worst, flat_index[good], flags[good])
+
+    return worst.reshape(n_profile, n_bin)
+
+
+def interpolate_parameters(ctd_xr, parameter_names, levels, masks):
+
+    # Linearly interpolate each parameter onto the standard levels.
+    # Profiles are placed end to end by adding an offset to the
+    # pressure of each profile so one interpolation covers the
+    # whole cruise. Levels outside the pressure range of good
+    # values in a profile are set to NaN so values are never
+    # interpolated between two profiles
+    n_profile = ctd_xr.sizes['N_profile']
+
+    pressure = get_profile_array(ctd_xr, 'CTDPRS')
+    pressure_good = masks['CTDPRS']
+
+    offset = 2 * max(np.nanmax(np.abs(pressure)), np.max(np.abs(levels))) + 1
+
+    profile_offset = np.arange(n_profile)[:, np.newaxis] * offset
+    target = (profile_offset + levels).ravel()
+
+    interpolated = {}
+    interpolated_flags = {}
+
+    for name in parameter_names:
+
+        if name == 'CTDPRS':
+            continue
+
+        good = pressure_good & masks[name]
+
+        values = get_profile_array(ctd_xr, name)
+
+        if not good.any():
+            interpolated[name] = np.full((n_profile, len(levels)), np.nan)
+            continue
+
+        xp = (pressure + profile_offset)[good]
+        fp = values[good]
+
+        order = np.argsort(xp, kind='stable')
+
+        result = np.interp(target, xp[order], fp[order]).reshape(n_profile, len(levels))
+
+        in_range = get_in_range_mask(pressure, good, levels)
+
+        interpolated[name] = np.where(in_range, result, np.nan)
+
+        if name + '_FLAG_W' in ctd_xr:
+            flags = get_interpolated_flags(ctd_xr, name, xp[order], good, order, target)
+            interpolated_flags[name] = flags.reshape(n_profile, len(levels))
+
+    in_range = get_in_range_mask(pressure, pressure_good, levels)
+
+    interpolated['CTDPRS'] = np.where(in_range, levels, np.nan)
+
+    if 'CTDPRS_FLAG_W' in ctd_xr and pressure_good.any():
+        xp = (pressure + profile_offset)[pressure_good]
+        order = np.argsort(xp, kind='stable')
+        flags = get_interpolated_flags(ctd_xr, 'CTDPRS', xp[order], pressure_good, order, target)
+        interpolated_flags['CTDPRS'] = flags.reshape(n_profile, len(levels))
+
+    return interpolated, interpolated_flags
+
+
+def get_interpolated_flags(ctd_xr, name, xp, good, order, target):
+
+    # Worst (largest) flag of the two values each level is
+    # interpolated from. xp is the sorted offset pressure of the
+    # good values and order sorts the good values the same way
+    flags = get_profile_array(ctd_xr, name + '_FLAG_W')[good][order].astype(np.int8)
+
+    right = np.clip(np.searchsorted(xp, target, side='right'), 0, len(xp) - 1)
+    left = np.clip(right - 1, 0, len(xp) - 1)
+
+    return np.maximum(flags[left], flags[right])
+
+
+def get_in_range_mask(pressure, good, levels):
+
+    # Standard levels inside the pressure range of the good values
+    # of each profile
+    good_pressure = np.where(good, pressure, np.nan)
+
+    with np.errstate(invalid='ignore'):
+        min_pressure = np.fmin.reduce(good_pressure, axis=1)[:, np.newaxis]
+        max_pressure = np.fmax.reduce(good_pressure, axis=1)[:, np.newaxis]
+
+        in_range = (levels >= min_pressure) & (levels <= max_pressure)
+
+    return in_range
+
+
+def get_standard_level_flags(values, flags, fill_value):
+
+    # Standard level values were made from values with accepted
+    # flags only, so the flag is the worst flag of those values
+    # where there is a value and fill where there isn't
+    return np.where(np.isfinite(values), flags, fill_value['flag']).astype(np.int8)
+
+
+def create_standard_level_dataset(ctd_xr, parameter_names, method, interval, levels, accepted_flags, fill_value):
+
+    if 'CTDPRS' not in parameter_names or 'CTDPRS' not in ctd_xr:
+        raise ValueError('CTDPRS is needed for standard levels')
+
+    levels = get_standard_levels(ctd_xr, interval, levels)
+
+    data_names = [name for name in parameter_names if 'FLAG' not in name]
+
+    masks = get_good_data_masks(ctd_xr, data_names, accepted_flags)
+
+    if method == 'bin':
+        values, flags = bin_parameters(ctd_xr, data_names, levels, masks)
+    elif method == 'interpolate':
+        values, flags = interpolate_parameters(ctd_xr, data_names, levels, masks)
+    else:
+        raise ValueError("Standard level method must be 'bin' or 'interpolate'")
+
+    variables_dict = {}
+
+    for name in parameter_names:
+
+        attrs = dict(ctd_xr[name].attrs)
+
+        if 'FLAG' in name:
+            data_name = name.replace('_FLAG_W', '')
+            data_values = values.get(data_name, np.full_like(values['CTDPRS'], np.nan))
+            data_flags = flags.get(data_name, np.full(data_values.shape, fill_value['flag']))
+            data = get_standard_level_flags(data_values, data_flags, fill_value)
+            attrs['comment'] = 'Worst flag of the values used, accepted flags {}'.format(list(accepted_flags))
+        else:
+            data = values[name]
+
+        variables_dict[name] = xr.DataArray(data, dims=['N_profile', 'N_level'], attrs=attrs)
+
+    # Metadata variables are the same as for the raw dataset
+    metadata_dict = {name: ctd_xr[name] for name in ctd_xr.coords if ctd_xr[name].dims == ('N_profile',)}
+
+    std_xr = xr.Dataset(data_vars=variables_dict, coords=metadata_dict, attrs=ctd_xr.attrs)
+
+    std_xr['CTDPRS'].attrs['comment'] = 'Standard pressure level ({} method)'.format(method)
+
+    # Pressure of each standard level
+    level_attrs = {'units': ctd_xr['CTDPRS'].attrs.get('units', ''), 'long_name': 'Standard pressure level'}
+    std_xr['STANDARD_LEVEL'] = xr.DataArray(levels, dims=['N_level'], attrs=level_attrs)
+
+    return std_xr
@@ -0,0 +1,163 @@
+"""
+
+Stream exchange ctd files into a NetCDF file one cast at a time
+
+The NetCDF file is created first with dimensions (N_profile, N_level)
+sized from a pre-pass over the files (see get_data_dimensions). Then
+each file is read in sorted order and its body is written directly
+into its profile row of the file. Only one cast is in memory at a time
+so memory does not grow with the size of the cruise.
+
+Levels past the end of a cast keep the variable fill value,
+NaN for parameters and 9 for flags, same as process_folder.
+The pressure index of each cast is written with the cast for
+all levels, same as process_folder. The C_format attribute of each
+parameter is set after all casts are written.
+
+input: sorted file list, metadata data series from the pre-pass,
+parameter types and attributes
+output: NetCDF file
+
+"""
+
+import numpy as np
+import netCDF4
+
+from get_data import get_file_content, get_metadata_content, get_parameter_content, get_body_content, update_format_info, get_parameter_formats
+from pressure_index import get_pressure_index
+
+
+def stream_files_to_netcdf(raw_files, netcdf_filename, n_level, metadata_ds, metadata_attributes, parameter_names, parameter_dtypes, parameter_attributes, global_attributes, pressure_range=None):
+
+    nc = create_netcdf_file(netcdf_filename, len(raw_files), n_level, global_attributes)
+
+    try:
+        write_metadata(nc, metadata_ds, metadata_attributes)
+
+        create_parameter_variables(nc, parameter_names, parameter_dtypes, parameter_attributes, list(metadata_ds))
+
+        if 'CTDPRS' in parameter_names:
+            create_pressure_index_variables(nc, parameter_attributes['CTDPRS'].get('units', ''))
+
+        format_info = {}
+
+        for profile, datafile in enumerate(raw_files):
+
+            file_content = get_file_content(datafile)
+
+            _, end_metadata_line = get_metadata_content(file_content)
+
+            file_parameter_names, _, end_parameter_line = get_parameter_content(file_content, end_metadata_line)
+
+            body_df = get_body_content(file_content, file_parameter_names, end_parameter_line, parameter_names, pressure_range)
+
+            write_profile(nc, profile, body_df, parameter_dtypes)
+
+            # Formats are from the values of all casts
+            format_info = update_format_info(format_info, body_df)
+
+        for name, value_format in get_parameter_formats(format_info).items():
+            nc[name].setncattr('C_format', value_format)
+
+    finally:
+        nc.close()
+
+
+def create_netcdf_file(netcdf_filename, n_profile, n_level, global_attributes):
+
+    nc = netCDF4.Dataset(netcdf_filename, 'w', format='NETCDF4')
+
+    nc.createDimension('N_profile', n_profile)
+    nc.createDimension('N_level', n_level)
+
+    nc.setncatts(global_attributes)
+
+    return nc
+
+
+def write_metadata(nc, metadata_ds, metadata_attributes):
+
+    # Metadata is small so it is written for all profiles at once.
+    # No fill value is set for metadata, same as set_metadata_encoding
+    for name, values in metadata_ds.items():
+
+        attributes = dict(metadata_attributes.get(name, {}))
+
+        if values.dtype.kind == 'M':
+            # Save datetime as seconds since 1970, NaT as NaN
+            values = (values - np.datetime64('1970-01-01T00:00:00')) / np.timedelta64(1, 's')
+            attributes['units'] = 'seconds since 1970-01-01 00:00:00'
+            attributes['calendar'] = 'proleptic_gregorian'
+            variable = nc.createVariable(name, np.float64, ('N_profile',), fill_value=False)
+
+        elif values.dtype.kind == 'S':
+            # Save fixed width strings as a char array
+            string_dim = 'string{}'.format(values.dtype.itemsize)
+            if string_dim not in nc.dimensions:
+                nc.createDimension(string_dim, values.dtype.itemsize)
+            variable = nc.createVariable(name, 'S1', ('N_profile', string_dim), fill_value=False)
+            values = values.view('S1').reshape(len(values), values.dtype.itemsize)
+
+        else:
+            variable = nc.createVariable(name, values.dtype, ('N_profile',), fill_value=False)
+
+        variable[:] = values
+        variable.setncatts(attributes)
+
+
+def create_parameter_variables(nc, parameter_names, parameter_dtypes, parameter_attributes, metadata_names):
+
+    # Fill value of parameters is NaN and flags use the _FillValue
+    # attribute. It has to be set when the variable is created.
+    # Metadata are listed as coordinates same as xarray does.
+    for name in parameter_names:
+
+        attributes = dict(parameter_attributes[name])
+        attributes['coordinates'] = ' '.join(metadata_names)
+
+        fill_value = attributes.pop('_FillValue', np.nan)
+
+        variable = nc.createVariable(name, parameter_dtypes[name], ('N_profile', 'N_level'), fill_value=fill_value)
+
+        variable.setncatts(attributes)
+
+
+def create_pressure_index_variables(nc, units):
+
+    # Same variables as pressure_index.add_pressure_index_to_xarray
+    variable = nc.createVariable('PROFILE_N_LEVEL', np.int32, ('N_profile',), fill_value=False)
+    variable.setncatts({'long_name': 'Number of levels in profile'})
+
+    variable = nc.createVariable('PRESSURE_INDEX_MAX', np.float64, ('N_profile', 'N_level'), fill_value=np.nan)
+    variable.setncatts({'units': units, 'long_name': 'Running maximum of CTDPRS'})
+
+    variable = nc.createVariable('PRESSURE_INDEX_MIN', np.float64, ('N_profile', 'N_level'), fill_value=np.nan)
+    variable.setncatts({'units': units, 'long_name': 'Running minimum of CTDPRS from the last level'})
+
+
+def write_profile(nc, profile, body_df, parameter_dtypes):
+
+    n_rows = len(body_df)
+
+    if n_rows:
+        for name in body_df.columns:
+            nc[name][profile, :n_rows] = body_df[name].astype(parameter_dtypes[name]).values
+
+    # Index is written for every profile, also ones without rows
+    if 'PROFILE_N_LEVEL' in nc.variables:
+        write_pressure_index(nc, profile, body_df['CTDPRS'].astype(parameter_dtypes['CTDPRS']).values)
+
+
+def write_pressure_index(nc, profile, pressure):
+
+    # Pad the pressure of the cast with NaN to all levels so the
+    # index is padded the same as add_pressure_index_to_xarray,
+    # with the carried maximum and +inf past the last level
+    padded_pressure = np.full((1, nc.dimensions['N_level'].size), np.nan)
+    padded_pressure[0, :len(pressure)] = pressure
+
+    profile_n_level, index_max, index_min = get_pressure_index(padded_pressure)
+
+    nc['PROFILE_N_LEVEL'][profile] = profile_n_level[0]
+    nc['PRESSURE_INDEX_MAX'][profile, :] = index_max[0]
+    nc['PRESSURE_INDEX_MIN'][profile, :] = index_min[0]
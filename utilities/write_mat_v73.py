@@ -0,0 +1,112 @@
+"""
+Write a MATLAB v7.3 (HDF5) mat file.
+
+scipy.io.savemat only writes v5 mat files, which can't hold variables
+of 2 GB or more. A v7.3 mat file is an HDF5 file with a 512 byte
+MATLAB header at the start and a MATLAB_class attribute on each
+dataset. MATLAB stores arrays in column major order, so arrays are
+written transposed to keep the same shape as in numpy.
+
+Values can be numeric numpy arrays, string arrays (saved as char
+matrices), strings and dicts (saved as structs).
+
+"""
+
+import time
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+MATLAB_CLASSES = {
+    'float64': 'double',
+    'float32': 'single',
+    'int8': 'int8',
+    'int16': 'int16',
+    'int32': 'int32',
+    'int64': 'int64',
+    'uint8': 'uint8',
+    'uint16': 'uint16',
+    'uint32': 'uint32',
+    'uint64': 'uint64',
+    'bool': 'logical'
+}
+
+
+def write_mat_v73(filename, mat_dict):
+
+    if h5py is None:
+        raise ImportError('The h5py package is needed to write v7.3 mat files')
+
+    with h5py.File(filename, 'w', userblock_size=512) as f:
+        for name, value in mat_dict.items():
+            write_mat_value(f, name, value)
+
+    write_mat_header(filename)
+
+
+def write_mat_header(filename):
+
+    # 116 bytes of text, 8 bytes of subsystem offset, version 0x0200
+    # and the endian indicator, in the first 128 bytes of the userblock
+    text = 'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {} HDF5 schema 1.00 .'.format(time.strftime('%a %b %d %H:%M:%S %Y'))
+
+    header = text.encode('ascii').ljust(116, b' ') + b'\x00' * 8 + b'\x00\x02' + b'IM'
+
+    with open(filename, 'r+b') as f:
+        f.write(header)
+
+
+def write_mat_value(group, name, value):
+
+    if isinstance(value, dict):
+        subgroup = group.create_group(name)
+        subgroup.attrs['MATLAB_class'] = np.bytes_('struct')
+
+        for key, item in value.items():
+            write_mat_value(subgroup, key, item)
+
+        return
+
+    if isinstance(value, str):
+        value = np.array([value])
+
+    value = np.asarray(value)
+
+    if value.dtype.kind in ('U', 'S', 'O'):
+        write_mat_char(group, name, value)
+        return
+
+    # 1-D arrays are saved as MATLAB column vectors
+    if value.ndim < 2:
+        value = value.reshape(-1, 1)
+
+    if value.dtype == bool:
+        value = value.astype(np.uint8)
+        matlab_class = 'logical'
+    else:
+        matlab_class = MATLAB_CLASSES[value.dtype.name]
+
+    dataset = group.create_dataset(name, data=value.T, compression='gzip')
+    dataset.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+
+
+def write_mat_char(group, name, value):
+
+    # Strings are saved as a char matrix with one row per string
+    # padded with spaces, stored as uint16 character codes
+    strings = [item.decode('utf-8') if isinstance(item, bytes) else str(item) for item in value.ravel()]
+
+    width = max([len(item) for item in strings] + [1])
+
+    chars = np.full((len(strings), width), ord(' '), dtype=np.uint16)
+
+    for row, item in enumerate(strings):
+        chars[row, :len(item)] = [ord(char) for char in item]
+
+    dataset = group.create_dataset(name, data=chars.T, compression='gzip')
+    dataset.attrs['MATLAB_class'] = np.bytes_('char')
+    dataset.attrs['MATLAB_int_decode'] = np.int32(2)
@@ -0,0 +1,293 @@
+"""
+
+Write exchange ctd files from a converted dataset
+
+Reverse of process_folder. Takes the xarray dataset from process_folder
+or a NetCDF file saved by save_as_netcdf and writes one exchange ctd
+file per profile with
+
+  the lines before NUMBER_HEADERS (exchange_header global attribute)
+  NUMBER_HEADERS = <number of metadata lines + 1>
+  a <name> = <value> line for each metadata variable
+  parameter names line and units line
+  body lines of values
+  END_DATA
+
+Values are written with the C_format attribute saved from the original
+files so the width and number of decimals are the same. Each column
+of a profile is formatted at once and profiles are written in parallel.
+
+Usage: python write_exchange.py <netcdf file>
+
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import sys
+import numpy as np
+import xarray as xr
+
+from config import Config
+
+from qc_flags import unpack_flags
+from pressure_index import to_padded_layout, INDEX_NAMES
+from derived_variables import get_derived_names
+
+
+def write_exchange_files(ctd_xr, exchange_dir, max_workers=None):
+
+    # Dataset can be given as a NetCDF filename. Don't mask fill
+    # values so flags keep their fill value of 9 as in the files
+    if isinstance(ctd_xr, (str, Path)):
+        ctd_xr = xr.open_dataset(ctd_xr, mask_and_scale=False)
+
+    Path(exchange_dir).mkdir(parents=True, exist_ok=True)
+
+    # Ragged files are put back on (N_profile, N_level)
+    if 'ROW_SIZE' in ctd_xr:
+        ctd_xr = to_padded_layout(ctd_xr, {'flag': 9})
+
+    ctd_xr = expand_flags(ctd_xr)
+
+    metadata_names = get_exchange_metadata_names(ctd_xr)
+    parameter_names = get_exchange_parameter_names(ctd_xr)
+
+    header_lines = get_header_lines(ctd_xr, metadata_names)
+
+    parameter_lines = get_parameter_lines(ctd_xr, parameter_names)
+
+    formats = [ctd_xr[name].attrs['C_format'] for name in parameter_names]
+
+    # Read each parameter once as a (N_profile, N_level) array
+    arrays = [get_parameter_array(ctd_xr, name) for name in parameter_names]
+
+    n_rows = get_number_of_rows(ctd_xr, parameter_names)
+
+    filenames = get_exchange_filenames(ctd_xr, exchange_dir)
+
+    # Arguments for each profile, only the rows of the profile are passed
+    profile_args = []
+
+    for profile, filename in enumerate(filenames):
+
+        columns = [values[profile, :n_rows[profile]] for values in arrays]
+
+        lines = header_lines[profile] + parameter_lines
+
+        profile_args.append((filename, lines, formats, columns))
+
+    if not profile_args:
+        return filenames
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(write_exchange_file, *zip(*profile_args)))
+
+    return filenames
+
+
+def write_exchange_file(filename, lines, formats, columns):
+
+    # Format each column of values at once then join columns
+    # with commas to make the body lines
+    body = None
+
+    for value_format, values in zip(formats, columns):
+
+        column = np.char.mod(value_format, values)
+
+        if body is None:
+            body = column
+        else:
+            body = np.char.add(np.char.add(body, ','), column)
+
+    with open(filename, 'w') as f:
+
+        f.write('\n'.join(lines) + '\n')
+
+        if body is not None and body.size:
+            f.write('\n'.join(body.tolist()) + '\n')
+
+        f.write('END_DATA\n')
+
+
+def expand_flags(ctd_xr):
+
+    # Flags saved as a flag matrix or packed flags are turned
+    # back into separate flag variables
+    if 'QC_FLAGS' in ctd_xr:
+        flag_name = 'QC_FLAGS'
+    elif 'QC_FLAGS_PACKED' in ctd_xr:
+        flag_name = 'QC_FLAGS_PACKED'
+    else:
+        return ctd_xr
+
+    attrs = ctd_xr[flag_name].attrs
+
+    flag_names = attrs['flag_variables'].split()
+
+    if flag_name == 'QC_FLAGS':
+        flag_matrix = ctd_xr[flag_name].transpose('N_profile', 'N_level', 'N_flag').values
+    else:
+        packed = ctd_xr[flag_name].transpose('N_profile', 'N_level', 'N_flag_byte').values
+        flag_matrix = unpack_flags(packed, len(flag_names))
+
+    flag_formats = attrs.get('flag_formats', ' '.join(['%d'] * len(flag_names))).split()
+
+    for index, name in enumerate(flag_names):
+        ctd_xr[name] = xr.DataArray(flag_matrix[..., index], dims=['N_profile', 'N_level'], attrs={'C_format': flag_formats[index]})
+
+    return ctd_xr.drop([flag_name])
+
+
+def get_exchange_metadata_names(ctd_xr):
+
+    # Metadata are the profile coordinates except DATETIME
+    # which was made from DATE and TIME
+    return [name for name in ctd_xr.coords if ctd_xr[name].dims == ('N_profile',) and name != 'DATETIME']
+
+
+def get_exchange_parameter_names(ctd_xr):
+
+    # Parameters are the (N_profile, N_level) variables read from
+    # the files. Variables added by the converter are not written.
+    # Each flag is written after its parameter as in the exchange files.
+    added_names = get_derived_names() + INDEX_NAMES
+
+    names = [name for name in ctd_xr.data_vars if set(ctd_xr[name].dims) == {'N_profile', 'N_level'} and name not in added_names and not name.endswith('_MASKED')]
+
+    missing = [name for name in names if 'C_format' not in ctd_xr[name].attrs]
+
+    if missing:
+        raise ValueError('Parameters without a C_format attribute: {}'.format(', '.join(missing)))
+
+    flag_names = [name for name in names if 'FLAG' in name]
+
+    parameter_names = []
+
+    for name in names:
+
+        if 'FLAG' in name:
+            continue
+
+        parameter_names.append(name)
+
+        if name + '_FLAG_W' in flag_names:
+            parameter_names.append(name + '_FLAG_W')
+
+    # Flags without a parameter go last
+    parameter_names.extend(name for name in flag_names if name not in parameter_names)
+
+    return parameter_names
+
+
+def get_header_lines(ctd_xr, metadata_names):
+
+    exchange_header = ctd_xr.attrs.get('exchange_header', 'CTD')
+
+    file_header = exchange_header.split('\n') if exchange_header else []
+
+    number_headers = 'NUMBER_HEADERS = {}'.format(len(metadata_names) + 1)
+
+    n_profile = ctd_xr.sizes['N_profile']
+
+    metadata_values = {name: format_metadata_values(ctd_xr[name]) for name in metadata_names}
+
+    header_lines = []
+
+    for profile in range(n_profile):
+
+        metadata_lines = ['{} = {}'.format(name, metadata_values[name][profile]) for name in metadata_names]
+
+        header_lines.append(file_header + [number_headers] + metadata_lines)
+
+    return header_lines
+
+
+def format_metadata_values(metadata_xr):
+
+    # Get metadata values of all profiles as strings
+    value_format = metadata_xr.attrs.get('C_format')
+
+    formatted = []
+
+    for value in metadata_xr.values:
+
+        if isinstance(value, bytes):
+            formatted.append(value.decode('utf-8').strip())
+        elif value_format:
+            formatted.append(value_format % value)
+        else:
+            formatted.append(str(value).strip())
+
+    return formatted
+
+
+def get_parameter_lines(ctd_xr, parameter_names):
+
+    units = [ctd_xr[name].attrs.get('units', '') for name in parameter_names]
+
+    return [','.join(parameter_names), ','.join(units)]
+
+
+def get_number_of_rows(ctd_xr, parameter_names):
+
+    # Rows of a profile go to the last level with a value.
+    # Levels after that are padding from combining profiles.
+    n_profile = ctd_xr.sizes['N_profile']
+    n_level = ctd_xr.sizes['N_level']
+
+    has_value = np.zeros((n_profile, n_level), dtype=bool)
+
+    for name in parameter_names:
+        if 'FLAG' not in name:
+            has_value |= np.isfinite(ctd_xr[name].transpose('N_profile', 'N_level').values)
+
+    last_level = n_level - np.argmax(has_value[:, ::-1], axis=1)
+
+    return np.where(has_value.any(axis=1), last_level, 0)
+
+
+def get_parameter_array(ctd_xr, name):
+
+    values = ctd_xr[name].transpose('N_profile', 'N_level').values
+
+    # NaN values inside a profile are written as the exchange fill value
+    if 'FLAG' not in name:
+        return np.where(np.isnan(values), -999, values)
+
+    if values.dtype.kind == 'f':
+        values = np.where(np.isnan(values), 9, values).astype(np.int8)
+
+    return values
+
+
+def get_exchange_filenames(ctd_xr, exchange_dir):
+
+    # Filename of form <expocode>_<station id>_<cast_number>_ct1.csv
+    # which is sorted by custom_sort_3_elems
+    filenames = []
+
+    expocodes = format_metadata_values(ctd_xr['EXPOCODE'])
+    stations = format_metadata_values(ctd_xr['STNNBR'])
+    casts = format_metadata_values(ctd_xr['CASTNO'])
+
+    for expocode, station, cast in zip(expocodes, stations, casts):
+
+        # Pad numbers so files sort in profile order
+        station = station.zfill(5) if station.isdigit() else station
+        cast = cast.zfill(5) if cast.isdigit() else cast
+
+        filename = '{}_{}_{}_ct1.csv'.format(expocode, station, cast)
+
+        filenames.append(Path(exchange_dir).joinpath(filename))
+
+    return filenames
+
+
+def main():
+
+    write_exchange_files(sys.argv[1], Config.EXCHANGE_DIR, Config.EXCHANGE_WORKERS)
+
+
+if __name__ == '__main__':
+    main()